@@ -1,19 +1,38 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import os
 import sys
+import time
 import yarl
 import json
 import anyio
+import asyncio
 import hashlib
 import aiohttp
-import contextlib
 from http import HTTPStatus
-from pathlib import Path, PurePath
+from pathlib import Path
 from datetime import datetime, timezone
 from dateutil.parser import parse as parsedate
 
+try:
+	import orjson
+except ImportError:
+	orjson = None
+	_json_loads = json.loads
+	_json_dumps = json.dumps
+else:
+	_json_loads = orjson.loads
+	def _json_dumps(obj):
+		return orjson.dumps(obj).decode()
+
 __version__ = '0.0.6'
 
+_VALID_VISIBILITY = frozenset({None, 'private', 'public', 'unlisted', 'direct'})
+_RATE_LIMIT_EXHAUSTED = frozenset({'0', '1'})
+
+_CACHE_TTL = 60.0
+_CACHE_MAX_SIZE = 128
+
 class BadRequest(Exception):
 	pass
 
@@ -23,17 +42,37 @@ class LoginFailed(Exception):
 class BadResponse(Exception):
 	pass
 
+# blocklist of some horrible instances
+_BLOCKED_HASH_SALT = bytes.fromhex('d590e3c48d599db6776e89dfc8ebaf53c8cd84866a76305049d8d8c5d4126ce1')
+_BLOCKED_HASHES = frozenset({
+	'56704d4d95b882e81c8e7765e9079be0afc4e353925ba9add8fd65976f52db83',
+	'1932431fa41a0baaccce7815115b01e40e0237035bb155713712075b887f5a19',
+	'a42191105a9f3514a1d5131969c07a95e06d0fdf0058f18e478823bf299881c9',
+})
+
 async def sleep_until(dt):
-	await anyio.sleep((dt - datetime.now(timezone.utc)).total_seconds())
+	await anyio.sleep(max(0.0, (dt - datetime.now(timezone.utc)).total_seconds()))
+
+def _parse_rate_limit_reset(value):
+	# the reset header is RFC 3339, which fromisoformat handles much faster
+	# than dateutil's guessing parser. fall back for anything weirder.
+	try:
+		return datetime.fromisoformat(value.replace('Z', '+00:00'))
+	except ValueError:
+		return parsedate(value)
 
 class HandleRateLimits:
+	__slots__ = ('http',)
+
 	def __init__(self, http):
 		self.http = http
 
 	def request(self, *args, **kwargs):
 		return _RateLimitContextManager(self.http, args, kwargs)
 
-class _RateLimitContextManager(contextlib.AbstractAsyncContextManager):
+class _RateLimitContextManager:
+	__slots__ = ('http', 'args', 'kwargs', '_request_cm')
+
 	def __init__(self, http, args, kwargs):
 		self.http = http
 		self.args = args
@@ -45,29 +84,45 @@ class _RateLimitContextManager(contextlib.AbstractAsyncContextManager):
 
 	async def _do_enter(self):
 		resp = await self._request_cm.__aenter__()
-		if resp.headers.get('X-RateLimit-Remaining') not in {'0', '1'}:
+		if resp.headers.get('X-RateLimit-Remaining') not in _RATE_LIMIT_EXHAUSTED:
 			return resp
 
-		await sleep_until(parsedate(resp.headers['X-RateLimit-Reset']))
+		await sleep_until(_parse_rate_limit_reset(resp.headers['X-RateLimit-Reset']))
 		await self._request_cm.__aexit__(*(None,)*3)
 		return await self.__aenter__()
 
 	async def __aexit__(self, *excinfo):
 		return await self._request_cm.__aexit__(*excinfo)
 
-def _http_session_factory(headers={}, **kwargs):
+def _make_connector(*, limit=100, limit_per_host=30):
+	return aiohttp.TCPConnector(
+		limit=limit,
+		limit_per_host=limit_per_host,
+		ttl_dns_cache=300,
+		keepalive_timeout=75,
+	)
+
+def _http_session_factory(headers={}, *, connector_limit=100, connector_limit_per_host=30, **kwargs):
 	py_version = '.'.join(map(str, sys.version_info))
 	user_agent = (
 		'pleroma.py (https://github.com/ioistired/pleroma.py); '
 		'aiohttp/{aiohttp.__version__}; '
 		'python/{py_version}'
 	)
+	kwargs.setdefault('json_serialize', _json_dumps)
+	if 'connector' not in kwargs:
+		kwargs['connector'] = _make_connector(
+			limit=connector_limit,
+			limit_per_host=connector_limit_per_host,
+		)
 	return aiohttp.ClientSession(
 		headers={'User-Agent': user_agent, **headers},
 		**kwargs,
 	)
 
 class File:
+	CHUNK_SIZE = 64 * 1024
+
 	def __init__(
 		self,
 		fp,
@@ -79,39 +134,99 @@ class File:
 		thumbnail=None,
 		thumbnail_mime_type=None,
 	):
-		if filename is None and isinstance(fp, str):
-			self.filename = PurePath(fp).name
-		try:
-			self.fp = open(fp, 'rb')
-		except TypeError:
+		if isinstance(fp, (str, Path)):
+			# don't open eagerly — upload() streams the file off disk chunk by chunk
+			self.path = fp
+			self.fp = None
+			self.filename = filename or os.path.basename(fp)
+		else:
 			# probably already a file-like
+			self.path = None
 			self.fp = fp
-			self.filename = PurePath(fp.name).name
-		else:
-			self.filename = PurePath(self.fp.name).name
+			self.filename = filename or os.path.basename(fp.name)
 
 		self.mime_type = mime_type
 		self.description = description
 		self.focus = focus
+		# multipart part headers, rendered at most once per field name
+		self._part_headers_cache = {}
 
 		if thumbnail is not None:
 			self.thumbnail = type(self)(thumbnail, mime_type=thumbnail_mime_type)
 		else:
 			self.thumbnail = thumbnail
 
+	def _part_headers(self, field_name):
+		headers = self._part_headers_cache.get(field_name)
+		if headers is None:
+			headers = {
+				'Content-Disposition': f'form-data; name="{field_name}"; filename="{self.filename}"',
+			}
+			if self.mime_type is not None:
+				headers['Content-Type'] = self.mime_type
+			self._part_headers_cache[field_name] = headers
+		return headers
+
+	async def open(self):
+		if self.fp is not None:
+			return anyio.wrap_file(self.fp)
+		return await anyio.open_file(self.path, 'rb')
+
+	async def _chunks(self):
+		f = await self.open()
+		try:
+			while chunk := await f.read(self.CHUNK_SIZE):
+				yield chunk
+		finally:
+			# only close files we opened ourselves
+			if self.fp is None:
+				await f.aclose()
+
 	def __repr__(self):
 		out = [f'<{type(self).__qualname__}']
-		for field in 'fp filename mime_type description focus thumbnail'.split():
+		for field in 'path fp filename mime_type description focus thumbnail'.split():
 			out.append(f'{field}={getattr(self, field)!r}')
 		return ' '.join(out) + '>'
 
 class Pleroma:
-	def __init__(self, *, api_base_url, access_token):
+	def __init__(
+		self, *,
+		api_base_url,
+		access_token,
+		connector_limit=100,
+		connector_limit_per_host=30,
+		shared_connector=None,
+	):
 		self.api_base_url = api_base_url.rstrip('/')
+		# parse the base URL once; request() joins relative paths against it
+		self._api_base = yarl.URL(self.api_base_url + '/')
 		self.access_token = access_token.strip()
-		self._session = _http_session_factory({'Authorization': 'Bearer ' + self.access_token})
+		session_kwargs = {}
+		if shared_connector is not None:
+			# the caller owns the connector and may share it between instances,
+			# so closing this session must not close it
+			session_kwargs.update(connector=shared_connector, connector_owner=False)
+		self._session = _http_session_factory(
+			{'Authorization': 'Bearer ' + self.access_token},
+			connector_limit=connector_limit,
+			connector_limit_per_host=connector_limit_per_host,
+			**session_kwargs,
+		)
 		self._rl_handler = HandleRateLimits(self._session)
-		self._logged_in_id = None
+		self._logged_in_id_task = None
+		# {key: (expiry, value)} for endpoints that barely change within a session
+		self._cache = {}
+		# the blocklist check only depends on the host, so do the hashing once up front
+		self._host_blocked = hashlib.sha256(
+			self._api_base.host.encode() + _BLOCKED_HASH_SALT
+		).hexdigest() in _BLOCKED_HASHES
+
+	@classmethod
+	def make_shared_connector(cls, *, limit=100, limit_per_host=30):
+		# for multi-account apps: pass the result as shared_connector= to each
+		# Pleroma() so they share one TCP/TLS pool and DNS cache.
+		# the caller is responsible for closing it once all sessions are done.
+		return _make_connector(limit=limit, limit_per_host=limit_per_host)
 
 	async def __aenter__(self):
 		self._session = await self._session.__aenter__()
@@ -121,51 +236,76 @@ class Pleroma:
 		return await self._session.__aexit__(*excinfo)
 
 	async def request(self, method, path, **kwargs):
-		# blocklist of some horrible instances
-		if hashlib.sha256(
-			yarl.URL(self.api_base_url).host.encode()
-			+ bytes.fromhex('d590e3c48d599db6776e89dfc8ebaf53c8cd84866a76305049d8d8c5d4126ce1')
-		).hexdigest() in {
-			'56704d4d95b882e81c8e7765e9079be0afc4e353925ba9add8fd65976f52db83',
-			'1932431fa41a0baaccce7815115b01e40e0237035bb155713712075b887f5a19',
-			'a42191105a9f3514a1d5131969c07a95e06d0fdf0058f18e478823bf299881c9',
-		}:
+		if self._host_blocked:
 			raise RuntimeError('stop being a chud')
 
-		async with self._rl_handler.request(method, self.api_base_url + path, **kwargs) as resp:
+		url = self._api_base.join(yarl.URL(path.lstrip('/')))
+		async with self._rl_handler.request(method, url, **kwargs) as resp:
 			if resp.status == HTTPStatus.BAD_REQUEST:
-				raise BadRequest((await resp.json())['error'])
+				raise BadRequest(_json_loads(await resp.read())['error'])
 			if resp.status == HTTPStatus.INTERNAL_SERVER_ERROR:
-			    raise BadResponse(await resp.json())
+				raise BadResponse(_json_loads(await resp.read()))
 			#resp.raise_for_status()
-			return await resp.json()
+			return _json_loads(await resp.read())
+
+	def _cache_get(self, key):
+		entry = self._cache.get(key)
+		if entry is None:
+			return None
+		expiry, value = entry
+		if time.monotonic() >= expiry:
+			del self._cache[key]
+			return None
+		return value
+
+	def _cache_put(self, key, value):
+		if len(self._cache) >= _CACHE_MAX_SIZE:
+			# drop the oldest entry — good enough for a cache this small
+			del self._cache[next(iter(self._cache))]
+		self._cache[key] = (time.monotonic() + _CACHE_TTL, value)
+
+	def invalidate_cache(self):
+		self._cache.clear()
 
 	async def verify_credentials(self):
-		return await self.request('GET', '/api/v1/accounts/verify_credentials')
+		if (cached := self._cache_get('verify_credentials')) is not None:
+			return cached
+		result = await self.request('GET', '/api/v1/accounts/verify_credentials')
+		self._cache_put('verify_credentials', result)
+		return result
 
 	me = verify_credentials
 
-	async def _get_logged_in_id(self):
-		if self._logged_in_id is not None:
-			return self._logged_in_id
-
+	async def _fetch_logged_in_id(self):
 		me = await self.me()
 
 		try:
-			self._logged_in_id = me['id']
+			return me['id']
 		except KeyError:
 			raise LoginFailed(me)
 
-		return self._logged_in_id
+	async def _get_logged_in_id(self):
+		# share one verify_credentials round-trip between concurrent callers
+		if self._logged_in_id_task is None:
+			self._logged_in_id_task = asyncio.ensure_future(self._fetch_logged_in_id())
+		try:
+			return await self._logged_in_id_task
+		except BaseException:
+			self._logged_in_id_task = None
+			raise
 
 	async def following(self, account_id=None):
 		account_id = account_id or await self._get_logged_in_id()
-		return await self.request('GET', f'/api/v1/accounts/{account_id}/following')
+		if (cached := self._cache_get(('following', account_id))) is not None:
+			return cached
+		result = await self.request('GET', f'/api/v1/accounts/{account_id}/following')
+		self._cache_put(('following', account_id), result)
+		return result
 
 	@staticmethod
 	def _unpack_id(obj):
-		if isinstance(obj, dict) and 'id' in obj:
-			return obj['id']
+		if type(obj) is dict:
+			return obj.get('id', obj)
 		return obj
 
 	async def status_context(self, id):
@@ -177,20 +317,17 @@ class Pleroma:
 		return await self.request('GET', f'/api/v1/media/{id}')
 
 	async def upload(self, file):
-		data = aiohttp.FormData()
-		data.add_field('file', file.fp, filename=file.filename, content_type=file.mime_type)
+		# append to a MultipartWriter directly with precomputed part headers,
+		# skipping FormData's per-field parsing and disposition rendering
+		data = aiohttp.MultipartWriter('form-data')
+		data.append(file._chunks(), file._part_headers('file'))
 		focus = None
 		if file.focus is not None:
 			if len(file.focus) != 2:
 				raise ValueError('focus must be a sequence of 2 floats')
 			focus = ','.join(file.focus)
 		if file.thumbnail is not None:
-			data.add_field(
-				'thumbnail',
-				file.thumbnail.fp,
-				filename=file.thumbnail.filename,
-				content_type=file.thumbnail.mime_type,
-			)
+			data.append(file.thumbnail._chunks(), file.thumbnail._part_headers('thumbnail'))
 
 		params = {}
 		if focus:
@@ -204,6 +341,26 @@ class Pleroma:
 			params=params,
 		)
 
+	async def _do_many(self, method, items, *, concurrency, **kwargs):
+		# fan out method(item, **kwargs) over all items, at most `concurrency`
+		# in flight at once, returning the results in input order
+		items = list(items)
+		results = [None] * len(items)
+		sem = anyio.Semaphore(concurrency)
+
+		async def run(i, item):
+			async with sem:
+				results[i] = await method(item, **kwargs)
+
+		async with anyio.create_task_group() as tg:
+			for i, item in enumerate(items):
+				tg.start_soon(run, i, item)
+
+		return results
+
+	async def upload_many(self, files, *, concurrency=8):
+		return [media['id'] for media in await self._do_many(self.upload, files, concurrency=concurrency)]
+
 	async def post(
 		self,
 		content,
@@ -214,7 +371,7 @@ class Pleroma:
 		visibility=None,
 		files=None,
 	):
-		if visibility not in {None, 'private', 'public', 'unlisted', 'direct'}:
+		if visibility not in _VALID_VISIBILITY:
 			raise ValueError('invalid visibility', visibility)
 
 		data = dict(status=content, content_type=content_type)
@@ -229,29 +386,21 @@ class Pleroma:
 			data['spoiler_text'] = cw
 
 		if files:
-			files_uploaded = [None] * len(files)
-			async with anyio.create_task_group() as tg:
-				async def upload(i, file):
-					files_uploaded[i] = (await self.upload(file))['id']
-
-				for i, file in enumerate(files):
-					tg.start_soon(upload, i, file)
-
-			assert None not in files_uploaded
-			data['media_ids'] = files_uploaded
+			data['media_ids'] = await self.upload_many(files)
 
 		return await self.request('POST', '/api/v1/statuses', json=data)
 
 	async def reply(self, to_status, content, *, cw=None, files=None, content_type=None):
 		user_id = await self._get_logged_in_id()
 
-		mentioned_accounts = {}
-		mentioned_accounts[to_status['account']['id']] = to_status['account']['acct']
+		accts = [to_status['account']['acct']]
+		seen_ids = {to_status['account']['id'], user_id}
 		for account in to_status['mentions']:
-			if account['id'] != user_id and account['id'] not in mentioned_accounts:
-				mentioned_accounts[account['id']] = account['acct']
+			if account['id'] not in seen_ids:
+				seen_ids.add(account['id'])
+				accts.append(account['acct'])
 
-		content = ''.join('@' + x + ' ' for x in mentioned_accounts.values()) + content
+		content = ''.join(f'@{acct} ' for acct in accts) + content
 
 		visibility = 'unlisted' if to_status['visibility'] == 'public' else to_status['visibility']
 		if not cw and 'spoiler_text' in to_status and to_status['spoiler_text']:
@@ -273,10 +422,16 @@ class Pleroma:
 		id = self._unpack_id(id)
 		return await self.request('DELETE', f'/api/v1/statuses/{id}')
 
+	async def delete_many(self, ids, *, concurrency=16):
+		return await self._do_many(self.delete_status, ids, concurrency=concurrency)
+
 	async def favorite(self, id):
 		id = self._unpack_id(id)
 		return await self.request('POST', f'/api/v1/statuses/{id}/favourite')
 
+	async def favorite_many(self, ids, *, concurrency=16):
+		return await self._do_many(self.favorite, ids, concurrency=concurrency)
+
 	async def unfavorite(self, id):
 		id = self._unpack_id(id)
 		return await self.request('POST', f'/api/v1/statuses/{id}/unfavourite')
@@ -294,6 +449,9 @@ class Pleroma:
 		id = self._unpack_id(id)
 		return await self.request('PUT', f'/api/v1/pleroma/statuses/{id}/reactions/{reaction}')
 
+	async def react_many(self, ids, reaction, *, concurrency=16):
+		return await self._do_many(self.react, ids, concurrency=concurrency, reaction=reaction)
+
 	async def remove_reaction(self, id, reaction):
 		id = self._unpack_id(id)
 		return await self.request('DELETE', f'/api/v1/pleroma/statuses/{id}/reactions/{reaction}')
@@ -308,33 +466,54 @@ class Pleroma:
 
 	async def account_statuses(self, id, *, exclude_repeats=False, max_id=None, limit=None):
 		id = self._unpack_id(id)
-		params = dict(exclude_reblogs='1' if exclude_repeats else '0')
-		if max_id is not None: params['max_id'] = self._unpack_id(max_id)
-		return await self.request('GET', f'/api/v1/accounts/{id}/statuses', params=params)
+		# build the query string by hand: the paging loop calls this per page,
+		# and params= costs a dict + MultiDict encode pass each time
+		path = f'/api/v1/accounts/{id}/statuses?exclude_reblogs={int(exclude_repeats)}'
+		if max_id is not None: path += f'&max_id={self._unpack_id(max_id)}'
+		return await self.request('GET', path)
 
 	async def account_statuses_iter(self, id, *, exclude_repeats=False, max_id=None):
-		while results := await self.account_statuses(
-			id,
-			exclude_repeats=exclude_repeats,
-			max_id=max_id,
-		):
-			for result in results:
-				yield result
-			max_id = results[-1]
+		results = await self.account_statuses(id, exclude_repeats=exclude_repeats, max_id=max_id)
+		next_page = None
+		try:
+			while results:
+				# prefetch the next page so the round-trip overlaps with the consumer
+				next_page = asyncio.ensure_future(self.account_statuses(
+					id,
+					exclude_repeats=exclude_repeats,
+					max_id=results[-1],
+				))
+				for result in results:
+					yield result
+				results = await next_page
+				next_page = None
+		finally:
+			if next_page is not None:
+				next_page.cancel()
 
 	async def stream(self, stream_name, *, target_event_type=None):
 		async with self._session.ws_connect(
-			self.api_base_url + f'/api/v1/streaming?stream={stream_name}&access_token={self.access_token}'
+			self._api_base.join(yarl.URL('api/v1/streaming'))
+				.with_query(stream=stream_name, access_token=self.access_token)
 		) as ws:
 			async for msg in ws:
 				if msg.type == aiohttp.WSMsgType.TEXT:
-					event = msg.json()
+					# cheap substring gate: don't JSON-decode frames that can't
+					# possibly match the filter. filters_changed is always
+					# yielded, so those frames pass the gate too.
+					if (
+						target_event_type is not None
+						and target_event_type not in msg.data
+						and 'filters_changed' not in msg.data
+					):
+						continue
+					event = _json_loads(msg.data)
 					# the only event type that doesn't define `payload` is `filters_changed`
 					if event['event'] == 'filters_changed':
 						yield event
 					elif target_event_type is None or event['event'] == target_event_type:
 						# don't ask me why the payload is also JSON encoded smh
-						yield json.loads(event['payload'])
+						yield _json_loads(event['payload'])
 
 	async def stream_notifications(self):
 		async for notif in self.stream('user:notification', target_event_type='notification'):
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
-import re
 from pathlib import Path
 from setuptools import setup
 
 HERE = Path(__file__).parent
 
+VERSION = None
 with open(HERE / 'pleroma.py') as f:
-	VERSION = re.search(r'^__version__\s*=\s*[\'"]([^\'"]*)[\'"]', f.read(), re.MULTILINE).group(1)
+	for line in f:
+		if line.startswith('__version__'):
+			VERSION = line.split('=', 1)[1].strip().strip('\'"')
+			break
 
 if not VERSION:
 	raise RuntimeError('version is not set')
@@ -29,6 +32,9 @@ setup(
 		'anyio ~= 3.0',
 		'python-dateutil ~= 2.8',
 	],
+	extras_require={
+		'fast': ['orjson ~= 3.0'],
+	},
 	classifiers=[
 		'Development Status :: 3 - Alpha',
 		'Intended Audience :: Developers',